@@ -18,6 +18,29 @@ TTS_API_URL = "https://openspeech.bytedance.com/api/v3/tts/unidirectional"
 TTS_RESOURCE_ID = "volc.service_type.10029"
 TTS_SPEAKER = os.getenv("TTS_SPEAKER", "zh_male_beijingxiaoye_emo_v2_mars_bigtts")
 
+# ================= 坐姿平滑配置 =================
+# EWMA 平滑系数，越大越偏向最新一帧
+SMOOTHING_ALPHA = float(os.getenv("SMOOTHING_ALPHA", "0.5"))
+# 滞回阈值：平滑分低于 BAD 判为不合格，回到 GOOD 以上才恢复合格
+SMOOTHING_BAD_THRESHOLD = int(os.getenv("SMOOTHING_BAD_THRESHOLD", "75"))
+SMOOTHING_GOOD_THRESHOLD = int(os.getenv("SMOOTHING_GOOD_THRESHOLD", "85"))
+# 连续不合格多少帧后才提醒
+SMOOTHING_SUSTAIN_FRAMES = int(os.getenv("SMOOTHING_SUSTAIN_FRAMES", "2"))
+# 两次语音提醒的最小间隔（秒）
+REMINDER_COOLDOWN_SECONDS = float(os.getenv("REMINDER_COOLDOWN_SECONDS", "120"))
+# 会话空闲多久后重置平滑状态（秒）
+SMOOTHING_SESSION_TTL = float(os.getenv("SMOOTHING_SESSION_TTL", "1800"))
+
+# ================= 离线补传配置 =================
+# 单次批量补传的最大记录数
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+# 批量补传时同时分析的记录数
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# 幂等键保留时长（秒），超过后同一键的补传不再去重
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", str(7 * 24 * 3600)))
+# 幂等键处于处理中状态的最长时间（秒），超时视为处理中断
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT", "300"))
+
 # ================= 日志配置 =================
 LOG_DIR = os.path.join(os.path.dirname(__file__), "logs")
 
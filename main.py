@@ -2,17 +2,23 @@
 智能坐姿守护助手 (Posture Guardian)
 主入口文件 - FastAPI 应用
 """
+import asyncio
 import logging
 from pathlib import Path
 from datetime import datetime
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
-from config import ARK_API_KEY, ARK_MODEL_NAME, TTS_API_KEY, TTS_SPEAKER
+from pydantic import ValidationError
+
+from config import ARK_API_KEY, ARK_MODEL_NAME, TTS_API_KEY, TTS_SPEAKER, BATCH_MAX_ITEMS, BATCH_CONCURRENCY
 from services.vision_service import VisionService
 from services.tts_service import TTSService
 from services.logger_service import LoggerService
+from services.smoothing_service import SmoothingService
+from models.response_models import DetectionResponse, PostureAnalysisResult
 
 # 配置日志
 logging.basicConfig(
@@ -39,6 +45,7 @@ app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
 vision_service = VisionService()
 tts_service = TTSService()
 logger_service = LoggerService()
+smoothing_service = SmoothingService()
 
 
 # ================= 路由 =================
@@ -60,7 +67,10 @@ async def check_posture(request: Request):
     
     请求体:
         {
-            "image": "data:image/jpeg;base64,..."
+            "image": "data:image/jpeg;base64,...",
+            "session_id": "可选，前端会话标识，用于跨帧平滑",
+            "include_raw": false,  // 可选，为 true 时额外返回 raw_result
+            "idempotency_key": "可选，客户端生成的唯一键，离线补传时用于去重"
         }
     
     响应:
@@ -70,6 +80,7 @@ async def check_posture(request: Request):
             "is_qualified": false,
             "issues": ["背部前倾", "眼睛离书本太近"],
             "suggestion": "...",
+            "smoothed": {"score": 78, "is_qualified": true, "should_remind": false},
             "audio": "base64音频数据..."
         }
     """
@@ -80,15 +91,23 @@ async def check_posture(request: Request):
         return JSONResponse({"error": "Invalid JSON"}, status_code=400)
     
     image_data = data.get("image")
+    session_id = data.get("session_id") or (request.client.host if request.client else "default")
+    include_raw = bool(data.get("include_raw", False))
+    idempotency_key = data.get("idempotency_key")
+    if not isinstance(idempotency_key, str):
+        idempotency_key = None
     
-    if not image_data:
+    if not image_data or not isinstance(image_data, str):
         return JSONResponse({"error": "No image provided"}, status_code=400)
 
-    # 移除 base64 头部 (data:image/jpeg;base64,...)
-    if "," in image_data:
-        image_base64 = image_data.split(",")[1]
-    else:
-        image_base64 = image_data
+    # 先占用幂等键，客户端放弃等待后补传同一张抓拍时不会重复保存
+    should_save = True
+    if idempotency_key and not logger_service.claim_idempotency_key(idempotency_key):
+        logger.info(f"幂等键已保存或正在处理，本次检测结果不再保存: {idempotency_key}")
+        should_save = False
+        idempotency_key = None
+
+    image_base64 = _strip_data_url(image_data)
 
     # 记录时间戳
     timestamp = datetime.now()
@@ -96,7 +115,9 @@ async def check_posture(request: Request):
     # 调用视觉模型分析（返回解析结果和完整响应）
     parsed_result, full_response = vision_service.analyze_posture(image_base64)
     
-    if not parsed_result:
+    if parsed_result is None:
+        if idempotency_key:
+            logger_service.release_idempotency_key(idempotency_key)
         return JSONResponse({
             "error": "AI Analysis failed",
             "score": 0,
@@ -108,40 +129,48 @@ async def check_posture(request: Request):
     # 保存检测记录（截图和完整的API返回结果，包括思考过程）
     # 构建完整的记录，包含解析结果和完整响应
     complete_response = {
-        "parsed_result": parsed_result,  # 解析后的结果
+        "parsed_result": parsed_result.model_dump(),  # 解析后的结果
         "full_api_response": full_response  # 完整的API响应，包括思考过程等所有字段
     }
     
-    save_result = logger_service.save_detection_record(
-        image_base64=image_base64,
-        api_response=complete_response,
-        timestamp=timestamp
-    )
-    
-    if save_result.get("success"):
-        logger.info(f"检测记录已保存: {save_result.get('timestamp')}")
-    else:
-        logger.warning(f"检测记录保存失败: {save_result.get('error')}")
-
-    # 构建响应数据
-    response_data = {
-        "status": parsed_result.get("status", "normal"),
-        "score": parsed_result.get("score", 0),
-        "is_qualified": parsed_result.get("is_qualified", False),
-        "issues": parsed_result.get("issues", []),
-        "suggestion": parsed_result.get("suggestion", ""),
-        "audio": None,
-        "raw_result": parsed_result  # 包含完整的原始结果供前端显示
-    }
+    if should_save:
+        save_result = logger_service.save_detection_record(
+            image_base64=image_base64,
+            api_response=complete_response,
+            timestamp=timestamp,
+            idempotency_key=idempotency_key
+        )
+        
+        if save_result.get("success"):
+            logger.info(f"检测记录已保存: {save_result.get('timestamp')}")
+        else:
+            logger.warning(f"检测记录保存失败: {save_result.get('error')}")
+            if idempotency_key:
+                logger_service.release_idempotency_key(idempotency_key)
+
+    smoothed = smoothing_service.update(session_id, parsed_result)
+
+    # 仅在持续不合格且未处于冷却期时，调用 TTS 生成语音
+    audio_base64 = None
+    if parsed_result.status == "normal" and smoothed.should_remind and parsed_result.suggestion:
+        audio_base64 = tts_service.synthesize(parsed_result.suggestion)
 
-    # 如果不合格且状态为 normal，调用 TTS 生成语音
-    status = response_data["status"]
-    suggestion = response_data["suggestion"]
-    if status == "normal" and not response_data["is_qualified"] and suggestion:
-        audio_base64 = tts_service.synthesize(suggestion)
-        response_data["audio"] = audio_base64
+    # 构建响应数据（各字段已在视觉服务中校验过，无需再次校验）
+    response_data = DetectionResponse.model_construct(
+        status=parsed_result.status,
+        score=parsed_result.score,
+        is_qualified=parsed_result.is_qualified,
+        issues=parsed_result.issues,
+        suggestion=parsed_result.suggestion,
+        smoothed=smoothed,
+        audio=audio_base64,
+        raw_result=parsed_result.model_dump() if include_raw else None
+    )
 
-    logger.info(f"检测完成: status={status}, 得分={response_data['score']}, 合格={response_data['is_qualified']}")
+    logger.info(
+        f"检测完成: status={parsed_result.status}, 得分={parsed_result.score}, 合格={parsed_result.is_qualified}, "
+        f"平滑得分={smoothed.score}, 提醒={smoothed.should_remind}"
+    )
     
     # 在日志中输出完整响应的关键信息（思考过程）
     if full_response and isinstance(full_response, dict):
@@ -154,7 +183,11 @@ async def check_posture(request: Request):
                         if reasoning_summary:
                             logger.info(f"思考过程: {reasoning_summary[0].get('text', '')[:200]}...")
     
-    return JSONResponse(response_data)
+    # 直接由 pydantic-core 编码为 JSON 字节，未请求时不返回 raw_result
+    return Response(
+        content=response_data.model_dump_json(exclude=None if include_raw else {"raw_result"}),
+        media_type="application/json"
+    )
 
 
 @app.get("/health")
@@ -179,6 +212,242 @@ async def get_records(date: str = None, limit: int = 100):
     })
 
 
+@app.post("/api/records/batch")
+async def ingest_records_batch(request: Request):
+    """
+    批量补传检测记录（设备离线期间缓存的抓拍）
+
+    每条记录按幂等键去重，重复提交的记录不会再次分析或保存；
+    同一键仍在其他请求中处理时返回 pending，客户端应稍后重试。
+    补传的记录只做分析和保存，不参与跨帧平滑，也不生成语音提醒。
+
+    请求体:
+        {
+            "items": [
+                {
+                    "idempotency_key": "客户端生成的唯一键",
+                    "timestamp": "2025-12-08T08:00:00.000Z",
+                    "image": "data:image/jpeg;base64,...",
+                    "result": {...}  // 可选，设备端已有的分析结果，提供时不再调用视觉模型
+                }
+            ]
+        }
+
+    响应:
+        {
+            "count": 2,
+            "created": 1,
+            "results": [
+                {"idempotency_key": "...", "status": "created", "timestamp": "...", "result": {...}},
+                {"idempotency_key": "...", "status": "duplicate", "timestamp": "...", "result": {...}}
+            ]
+        }
+    """
+    try:
+        data = await request.json()
+    except Exception as e:
+        logger.error(f"请求体解析失败: {e}")
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return JSONResponse({"error": "No items provided"}, status_code=400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"Too many items, max {BATCH_MAX_ITEMS}"}, status_code=413)
+
+    # 视觉分析和文件读写均为同步调用，放到线程池中并发执行（限制并发数），避免阻塞 /check
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def ingest(item):
+        async with semaphore:
+            return await run_in_threadpool(_ingest_batch_item, item)
+
+    # 单条记录的意外异常不影响同批其他记录
+    outcomes = await asyncio.gather(*(ingest(item) for item in items), return_exceptions=True)
+    results = []
+    for item, outcome in zip(items, outcomes):
+        if isinstance(outcome, BaseException):
+            logger.error(f"补传记录处理异常: {outcome}")
+            key = item.get("idempotency_key") if isinstance(item, dict) else None
+            outcome = {"idempotency_key": key, "status": "failed", "error": "Internal error"}
+        results.append(outcome)
+
+    created = sum(1 for r in results if r["status"] == "created")
+    logger.info(f"批量补传完成: 共 {len(results)} 条，新增 {created} 条")
+
+    return JSONResponse({
+        "count": len(results),
+        "created": created,
+        "results": results
+    })
+
+
+def _ingest_batch_item(item) -> dict:
+    """
+    处理单条补传记录
+
+    Args:
+        item: 请求中的单条记录
+
+    Returns:
+        处理结果字典，status 为 created / duplicate / pending / failed
+    """
+    if not isinstance(item, dict):
+        return {"idempotency_key": None, "status": "failed", "error": "Invalid item"}
+
+    key = item.get("idempotency_key")
+    if not key or not isinstance(key, str):
+        return {"idempotency_key": None, "status": "failed", "error": "Missing idempotency_key"}
+
+    timestamp = _parse_client_timestamp(item.get("timestamp"))
+    if timestamp is None:
+        return {"idempotency_key": key, "status": "failed", "error": "Invalid timestamp"}
+
+    image_data = item.get("image")
+    if not image_data or not isinstance(image_data, str):
+        return {"idempotency_key": key, "status": "failed", "error": "No image provided"}
+    image_base64 = _strip_data_url(image_data)
+
+    # 原子占用幂等键，占用失败说明已保存过或正在其他请求中处理
+    if not logger_service.claim_idempotency_key(key):
+        existing = logger_service.find_record_by_key(key)
+        if existing is None:
+            return {"idempotency_key": key, "status": "pending"}
+        return {
+            "idempotency_key": key,
+            "status": "duplicate",
+            "timestamp": existing.get("timestamp"),
+            "result": (existing.get("api_response") or {}).get("parsed_result")
+        }
+
+    # 占用后任何失败都要释放幂等键，客户端才能立即重试
+    try:
+        result = _process_claimed_item(key, item, image_base64, timestamp)
+    except Exception as e:
+        logger.error(f"补传记录处理失败 {key}: {e}")
+        result = {"idempotency_key": key, "status": "failed", "error": "Internal error"}
+    if result["status"] != "created":
+        logger_service.release_idempotency_key(key)
+    return result
+
+
+def _process_claimed_item(key: str, item: dict, image_base64: str, timestamp: datetime) -> dict:
+    """
+    分析并保存已占用幂等键的补传记录
+
+    Args:
+        key: 已占用的幂等键
+        item: 请求中的单条记录
+        image_base64: 去掉头部的 Base64 图片数据
+        timestamp: 抓拍时间
+
+    Returns:
+        处理结果字典，status 为 created / failed
+    """
+    if item.get("result") is not None:
+        try:
+            parsed_result = PostureAnalysisResult.model_validate(item["result"])
+        except ValidationError:
+            return {"idempotency_key": key, "status": "failed", "error": "Invalid result"}
+        full_response = None
+    else:
+        parsed_result, full_response = vision_service.analyze_posture(image_base64)
+        if parsed_result is None:
+            return {"idempotency_key": key, "status": "failed", "error": "AI Analysis failed"}
+
+    save_result = logger_service.save_detection_record(
+        image_base64=image_base64,
+        api_response={
+            "parsed_result": parsed_result.model_dump(),
+            "full_api_response": full_response
+        },
+        timestamp=timestamp,
+        idempotency_key=key
+    )
+    if not save_result.get("success"):
+        return {"idempotency_key": key, "status": "failed", "error": save_result.get("error")}
+
+    return {
+        "idempotency_key": key,
+        "status": "created",
+        "timestamp": save_result.get("timestamp"),
+        "result": parsed_result.model_dump()
+    }
+
+
+def _strip_data_url(image_data: str) -> str:
+    """移除 base64 头部 (data:image/jpeg;base64,...)"""
+    if "," in image_data:
+        return image_data.split(",")[1]
+    return image_data
+
+
+def _parse_client_timestamp(value):
+    """
+    解析客户端上报的 ISO 时间戳，统一转换为服务器本地时间（不含时区）
+
+    Args:
+        value: ISO 8601 时间字符串，如 2025-12-08T08:00:00.000Z
+
+    Returns:
+        datetime 对象，解析失败返回 None
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return timestamp
+
+
+# 导出格式 -> (生成器方法名, MIME 类型, 文件扩展名)
+EXPORT_FORMATS = {
+    "ndjson": ("export_ndjson", "application/x-ndjson", "ndjson"),
+    "csv": ("export_csv", "text/csv", "csv"),
+    "zip": ("export_zip", "application/zip", "zip"),
+}
+
+
+@app.get("/api/records/export")
+async def export_records(format: str = "ndjson", start: str = None, end: str = None, after: str = None):
+    """
+    流式导出检测记录
+
+    记录按时间顺序逐条读取并分块发送，任意时刻只持有一条记录的内容
+    （另需一份范围内文件名的列表，随记录数增长）；
+    生成器在线程池中执行，不会阻塞 /check 请求。
+
+    Args:
+        format: 导出格式 ndjson / csv / zip (zip 包含截图)，默认 ndjson
+        start: 起始日期 (YYYY-MM-DD)，包含当天，可选
+        end: 结束日期 (YYYY-MM-DD)，包含当天，可选
+        after: 断点续传游标，只导出 time_str 大于该值的记录，可选
+    """
+    if format not in EXPORT_FORMATS:
+        return JSONResponse({"error": f"Unsupported format: {format}"}, status_code=400)
+
+    for value in (start, end):
+        if value:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return JSONResponse({"error": f"Invalid date: {value}"}, status_code=400)
+
+    method_name, media_type, extension = EXPORT_FORMATS[format]
+    content = getattr(logger_service, method_name)(start_date=start, end_date=end, after=after)
+
+    filename = f"posture_records_{start or 'all'}_{end or 'now'}.{extension}"
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        # 内容为动态生成，不支持字节范围请求；中断后请使用 after 参数续传
+        "Accept-Ranges": "none",
+    }
+    return StreamingResponse(content, media_type=media_type, headers=headers)
+
+
 if __name__ == "__main__":
     import uvicorn
     
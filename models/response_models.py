@@ -1,17 +1,36 @@
 """
 响应数据模型
 """
-from typing import List, Optional
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 
 class PostureAnalysisResult(BaseModel):
-    """坐姿分析结果模型"""
-    status: str  # "normal" | "no_person" | "not_writing"
-    score: int  # 0-100
+    """坐姿分析结果模型（视觉模型输出，只在解析时校验一次）"""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    status: Literal["normal", "no_person", "not_writing"]
+    score: int = Field(ge=0, le=100)
     is_qualified: bool
-    issues: List[str]
-    suggestion: str
+    issues: List[str] = Field(default_factory=list)
+    suggestion: str = ""
+
+    @field_validator("issues", "suggestion", mode="before")
+    @classmethod
+    def _none_to_empty(cls, value, info):
+        """模型对合格帧常返回 null，统一转换为空值"""
+        if value is None:
+            return [] if info.field_name == "issues" else ""
+        return value
+
+
+class SmoothedResult(BaseModel):
+    """跨帧平滑结果模型"""
+    model_config = ConfigDict(frozen=True)
+
+    score: Optional[int] = None
+    is_qualified: bool = True
+    should_remind: bool = False
 
 
 class DetectionResponse(BaseModel):
@@ -21,6 +40,6 @@ class DetectionResponse(BaseModel):
     is_qualified: bool
     issues: List[str]
     suggestion: str
+    smoothed: SmoothedResult
     audio: Optional[str] = None
-    raw_result: dict
-
+    raw_result: Optional[dict] = None  # 仅在请求 include_raw 时返回
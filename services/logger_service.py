@@ -2,24 +2,39 @@
 日志记录服务 - 保存截图和API返回结果
 """
 import os
+import io
+import csv
 import json
 import base64
+import hashlib
+import time
 import logging
+import zipfile
+import threading
 from datetime import datetime
 from pathlib import Path
+from config import IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_PENDING_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
+# 同一毫秒内的记录文件名冲突时，追加序号的最大次数
+MAX_NAME_COLLISIONS = 1000
+# 两次清理过期幂等键之间的最小间隔（秒）
+KEY_CLEANUP_INTERVAL = 3600
+
 
 class LoggerService:
     """日志记录服务，用于保存检测记录"""
     
-    def __init__(self, log_dir: str = "logs"):
+    def __init__(self, log_dir: str = "logs", key_ttl: float = IDEMPOTENCY_KEY_TTL,
+                 pending_timeout: float = IDEMPOTENCY_PENDING_TIMEOUT):
         """
         初始化日志服务
         
         Args:
             log_dir: 日志目录路径
+            key_ttl: 幂等键保留时长（秒），过期后自动清理
+            pending_timeout: 幂等键处于处理中状态的最长时间（秒），超时视为处理中断可重新占用
         """
         self.log_dir = Path(log_dir)
         self.log_dir.mkdir(parents=True, exist_ok=True)
@@ -31,9 +46,19 @@ class LoggerService:
         self.results_dir = self.log_dir / "results"
         self.results_dir.mkdir(exist_ok=True)
         
+        # 幂等键索引：每个键一个文件，空文件表示处理中，否则内容为对应记录的 time_str
+        self.keys_dir = self.log_dir / "idempotency_keys"
+        self.keys_dir.mkdir(exist_ok=True)
+        self.key_ttl = key_ttl
+        self.pending_timeout = pending_timeout
+        self._last_key_cleanup = 0.0
+        self._cleanup_lock = threading.Lock()
+        self._reclaim_lock = threading.Lock()
+        
         logger.info(f"日志服务初始化完成，日志目录: {self.log_dir.absolute()}")
     
-    def save_detection_record(self, image_base64: str, api_response: dict, timestamp: datetime = None):
+    def save_detection_record(self, image_base64: str, api_response: dict, timestamp: datetime = None,
+                              idempotency_key: str = None):
         """
         保存检测记录（截图和API返回结果）
         
@@ -41,39 +66,60 @@ class LoggerService:
             image_base64: Base64编码的图片数据
             api_response: API返回的完整结果
             timestamp: 时间戳，如果为None则使用当前时间
+            idempotency_key: 已通过 claim_idempotency_key 占用的幂等键，可选；
+                保存后可通过 find_record_by_key 查询
         """
         if timestamp is None:
             timestamp = datetime.now()
         
         # 格式化时间戳
-        time_str = timestamp.strftime("%Y%m%d_%H%M%S_%f")[:-3]  # 精确到毫秒
+        base_time_str = timestamp.strftime("%Y%m%d_%H%M%S_%f")[:-3]  # 精确到毫秒
         date_str = timestamp.strftime("%Y-%m-%d")
         
+        result_path = None
+        image_path = None
         try:
-            # 1. 保存图片
-            image_filename = f"{time_str}.jpg"
-            image_path = self.images_dir / image_filename
-            
-            # 解码并保存图片
+            # 1. 先解码图片，数据无效时不占用任何文件名
             image_data = base64.b64decode(image_base64)
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
             
-            # 2. 保存API返回结果（JSON格式）
-            result_filename = f"{time_str}.json"
-            result_path = self.results_dir / result_filename
+            # 2. 独占创建结果文件，同一毫秒已有记录时追加序号，绝不覆盖已有记录
+            result_file = None
+            for attempt in range(MAX_NAME_COLLISIONS):
+                time_str = base_time_str if attempt == 0 else f"{base_time_str}_{attempt}"
+                candidate = self.results_dir / f"{time_str}.json"
+                try:
+                    result_file = open(candidate, 'x', encoding='utf-8')
+                    result_path = candidate
+                    break
+                except FileExistsError:
+                    continue
+            if result_file is None:
+                raise FileExistsError(f"记录文件名冲突过多: {base_time_str}")
+            result_filename = result_path.name
             
-            # 构建完整的记录
-            record = {
-                "timestamp": timestamp.isoformat(),
-                "time_str": time_str,
-                "date": date_str,
-                "image_filename": image_filename,
-                "api_response": api_response
-            }
+            with result_file:
+                # 3. 保存图片（与结果文件同名，结果文件已独占，图片名不会冲突）
+                image_filename = f"{time_str}.jpg"
+                image_path = self.images_dir / image_filename
+                with open(image_path, 'wb') as f:
+                    f.write(image_data)
+                
+                # 4. 保存API返回结果（JSON格式）
+                record = {
+                    "timestamp": timestamp.isoformat(),
+                    "time_str": time_str,
+                    "date": date_str,
+                    "image_filename": image_filename,
+                    "api_response": api_response
+                }
+                if idempotency_key:
+                    record["idempotency_key"] = idempotency_key
+                
+                json.dump(record, result_file, ensure_ascii=False, indent=2)
             
-            with open(result_path, 'w', encoding='utf-8') as f:
-                json.dump(record, f, ensure_ascii=False, indent=2)
+            # 5. 记录幂等键（在结果写入之后，保证键指向的记录一定存在）
+            if idempotency_key:
+                self._key_path(idempotency_key).write_text(time_str, encoding='utf-8')
             
             logger.info(f"检测记录已保存: {time_str} - 图片: {image_filename}, 结果: {result_filename}")
             
@@ -86,6 +132,13 @@ class LoggerService:
             
         except Exception as e:
             logger.error(f"保存检测记录失败: {e}")
+            # 清理本次写入的不完整文件，避免留下空记录或孤立截图
+            for path in (result_path, image_path):
+                if path is not None:
+                    try:
+                        path.unlink(missing_ok=True)
+                    except OSError:
+                        pass
             return {
                 "success": False,
                 "error": str(e)
@@ -126,4 +179,299 @@ class LoggerService:
         except Exception as e:
             logger.error(f"获取检测记录失败: {e}")
             return []
+    
+    def claim_idempotency_key(self, idempotency_key: str) -> bool:
+        """
+        原子地占用幂等键，占用成功后才能分析和保存对应的抓拍
+        
+        以 O_CREAT | O_EXCL 创建空的键文件作为"处理中"标记，并发请求中只有一个能占用成功。
+        处理中标记超过 pending_timeout 仍未完成时视为处理中断，允许重新占用。
+        
+        Args:
+            idempotency_key: 客户端生成的幂等键
+        
+        Returns:
+            是否占用成功；键已保存过或正在处理时返回 False
+        """
+        self._cleanup_expired_keys()
+        key_path = self._key_path(idempotency_key)
+        
+        for _ in range(2):
+            if self._create_key_marker(key_path):
+                return True
+            
+            try:
+                stat = key_path.stat()
+            except FileNotFoundError:
+                continue  # 其他请求刚释放了该键，重试一次
+            if stat.st_size > 0 or time.time() - stat.st_mtime < self.pending_timeout:
+                return False
+            
+            # 串行化重新占用：确认标记仍是刚才看到的那个过期标记后才删除，
+            # 避免并发请求删掉别人刚创建的新标记
+            with self._reclaim_lock:
+                try:
+                    current = key_path.stat()
+                except FileNotFoundError:
+                    continue
+                if (current.st_ino, current.st_mtime_ns, current.st_size) != \
+                        (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                    return False
+                
+                logger.warning(f"幂等键处理超时，重新占用: {idempotency_key}")
+                key_path.unlink(missing_ok=True)
+                return self._create_key_marker(key_path)
+        
+        return False
+    
+    def _create_key_marker(self, key_path: Path) -> bool:
+        """
+        以 O_CREAT | O_EXCL 创建空的"处理中"标记
+        
+        Args:
+            key_path: 键文件路径
+        
+        Returns:
+            是否创建成功；文件已存在时返回 False
+        """
+        try:
+            fd = os.open(key_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+    
+    def release_idempotency_key(self, idempotency_key: str):
+        """
+        释放处理失败的幂等键，使客户端可以重试
+        
+        Args:
+            idempotency_key: 已占用的幂等键
+        """
+        key_path = self._key_path(idempotency_key)
+        try:
+            # 只删除处理中标记，已保存的记录不受影响
+            if key_path.stat().st_size == 0:
+                key_path.unlink()
+        except FileNotFoundError:
+            pass
+    
+    def find_record_by_key(self, idempotency_key: str):
+        """
+        按幂等键查找已保存的检测记录
+        
+        Args:
+            idempotency_key: 客户端生成的幂等键
+        
+        Returns:
+            记录字典，未找到时返回 None
+        """
+        key_path = self._key_path(idempotency_key)
+        if not key_path.exists():
+            return None
+        
+        try:
+            time_str = key_path.read_text(encoding='utf-8').strip()
+            if not time_str:
+                return None  # 仍在处理中
+            with open(self.results_dir / f"{time_str}.json", 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"读取幂等键对应的记录失败 {idempotency_key}: {e}")
+            return None
+    
+    def _key_path(self, idempotency_key: str) -> Path:
+        """
+        获取幂等键索引文件路径（对键做哈希，避免非法文件名）
+        
+        Args:
+            idempotency_key: 客户端生成的幂等键
+        
+        Returns:
+            索引文件路径
+        """
+        digest = hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()
+        return self.keys_dir / digest
+    
+    def _cleanup_expired_keys(self):
+        """
+        清理超过 key_ttl 的幂等键文件（每 KEY_CLEANUP_INTERVAL 秒最多执行一次）
+        
+        记录 JSON 中仍保留 idempotency_key 字段，清理只影响去重窗口。
+        """
+        now = time.time()
+        if now - self._last_key_cleanup < KEY_CLEANUP_INTERVAL:
+            return
+        if not self._cleanup_lock.acquire(blocking=False):
+            return
+        
+        try:
+            self._last_key_cleanup = now
+            removed = 0
+            with os.scandir(self.keys_dir) as entries:
+                for entry in entries:
+                    try:
+                        if now - entry.stat().st_mtime > self.key_ttl:
+                            os.unlink(entry.path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+            if removed:
+                logger.info(f"已清理过期幂等键 {removed} 个")
+        except Exception as e:
+            logger.warning(f"清理过期幂等键失败: {e}")
+        finally:
+            self._cleanup_lock.release()
+    
+    def iter_detection_records(self, start_date: str = None, end_date: str = None, after: str = None):
+        """
+        按时间顺序逐条读取检测记录（惰性读取，任意时刻只持有一条记录的内容）
+
+        Args:
+            start_date: 起始日期 (YYYY-MM-DD)，包含当天，可选
+            end_date: 结束日期 (YYYY-MM-DD)，包含当天，可选
+            after: 只返回 time_str 大于该值的记录，用于断点续传，可选
+
+        Yields:
+            记录字典
+        """
+        for result_file in self._iter_result_files(start_date, end_date, after):
+            try:
+                with open(result_file, 'r', encoding='utf-8') as f:
+                    yield json.load(f)
+            except Exception as e:
+                logger.warning(f"读取记录文件失败 {result_file}: {e}")
+
+    def export_ndjson(self, start_date: str = None, end_date: str = None, after: str = None):
+        """
+        以 NDJSON 格式流式导出检测记录
+
+        Yields:
+            每条记录一行的字节串
+        """
+        for record in self.iter_detection_records(start_date, end_date, after):
+            yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def export_csv(self, start_date: str = None, end_date: str = None, after: str = None):
+        """
+        以 CSV 格式流式导出检测记录（仅包含解析后的结果，不含完整API响应）
+
+        Yields:
+            CSV 行的字节串
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def drain() -> bytes:
+            data = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            return data
+
+        # BOM 便于 Excel 正确识别中文
+        buffer.write("\ufeff")
+        writer.writerow(CSV_COLUMNS)
+        yield drain()
+
+        for record in self.iter_detection_records(start_date, end_date, after):
+            parsed = (record.get("api_response") or {}).get("parsed_result") or {}
+            writer.writerow([
+                record.get("timestamp", ""),
+                record.get("time_str", ""),
+                record.get("date", ""),
+                parsed.get("status", ""),
+                parsed.get("score", ""),
+                parsed.get("is_qualified", ""),
+                "|".join(parsed.get("issues") or []),
+                parsed.get("suggestion", ""),
+                record.get("image_filename", ""),
+            ])
+            yield drain()
+
+    def export_zip(self, start_date: str = None, end_date: str = None, after: str = None):
+        """
+        以 ZIP 格式流式导出检测记录及截图，目录结构与 logs/ 相同
+
+        Yields:
+            ZIP 数据块
+        """
+        stream = _ZipStream()
+        # 图片已是 JPEG 压缩格式，直接存储即可
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for result_file in self._iter_result_files(start_date, end_date, after):
+                zf.write(result_file, f"results/{result_file.name}")
+                yield stream.drain()
+
+                image_path = self.images_dir / f"{result_file.stem}.jpg"
+                if image_path.exists():
+                    zf.write(image_path, f"images/{image_path.name}")
+                    yield stream.drain()
+        yield stream.drain()
+
+    def _iter_result_files(self, start_date: str = None, end_date: str = None, after: str = None):
+        """
+        按时间顺序遍历结果文件
+
+        只扫描一次 results/ 目录，按文件名前缀（YYYYMMDD）过滤日期范围后排序。
+        内存占用随范围内的文件数增长，但只保存文件名，不读取文件内容。
+
+        Args:
+            start_date: 起始日期 (YYYY-MM-DD)，包含当天，可选
+            end_date: 结束日期 (YYYY-MM-DD)，包含当天，可选
+            after: 只返回 time_str 大于该值的记录，用于断点续传，可选
+
+        Yields:
+            结果文件路径
+        """
+        start = start_date.replace("-", "") if start_date else None
+        end = end_date.replace("-", "") if end_date else None
+
+        names = []
+        with os.scandir(self.results_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.endswith(".json"):
+                    continue
+                day = name[:8]
+                if start and day < start:
+                    continue
+                if end and day > end:
+                    continue
+                if after and name[:-5] <= after:
+                    continue
+                names.append(name)
+
+        names.sort()
+        for name in names:
+            yield self.results_dir / name
+
+
+# CSV 导出列
+CSV_COLUMNS = [
+    "timestamp", "time_str", "date", "status", "score",
+    "is_qualified", "issues", "suggestion", "image_filename",
+]
+
+
+class _ZipStream(io.RawIOBase):
+    """供 zipfile 写入的不可 seek 缓冲流，写入的数据可分块取出"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
 
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
@@ -0,0 +1,177 @@
+"""
+坐姿平滑服务 - 跨帧聚合检测结果，抑制单帧噪声引起的误提醒
+"""
+import time
+import logging
+import threading
+from config import (
+    SMOOTHING_ALPHA,
+    SMOOTHING_BAD_THRESHOLD,
+    SMOOTHING_GOOD_THRESHOLD,
+    SMOOTHING_SUSTAIN_FRAMES,
+    REMINDER_COOLDOWN_SECONDS,
+    SMOOTHING_SESSION_TTL,
+)
+from models.response_models import PostureAnalysisResult, SmoothedResult
+
+logger = logging.getLogger(__name__)
+
+
+class _SessionState:
+    """单个会话的平滑状态"""
+
+    __slots__ = ("smoothed_score", "is_qualified", "bad_streak", "last_reminded", "last_seen")
+
+    def __init__(self):
+        self.smoothed_score = None
+        self.is_qualified = True
+        self.bad_streak = 0
+        self.last_reminded = None  # 上次提醒时间
+        self.last_seen = 0.0
+
+
+class SmoothingService:
+    """
+    坐姿平滑服务
+
+    - 对 score 做指数加权移动平均 (EWMA)
+    - 对 is_qualified 做滞回判断：低于 bad_threshold 才判为不合格，
+      回到 good_threshold 以上才恢复合格
+    - 连续 sustain_frames 帧不合格才触发提醒，且两次提醒之间至少间隔 cooldown_seconds
+    """
+
+    def __init__(
+        self,
+        alpha: float = SMOOTHING_ALPHA,
+        bad_threshold: int = SMOOTHING_BAD_THRESHOLD,
+        good_threshold: int = SMOOTHING_GOOD_THRESHOLD,
+        sustain_frames: int = SMOOTHING_SUSTAIN_FRAMES,
+        cooldown_seconds: float = REMINDER_COOLDOWN_SECONDS,
+        session_ttl: float = SMOOTHING_SESSION_TTL,
+    ):
+        """
+        初始化平滑服务
+
+        Args:
+            alpha: EWMA 平滑系数 (0-1)，越大越偏向最新一帧
+            bad_threshold: 平滑分低于该值判为不合格
+            good_threshold: 平滑分不低于该值恢复合格
+            sustain_frames: 连续不合格多少帧后才提醒
+            cooldown_seconds: 两次提醒的最小间隔（秒）
+            session_ttl: 会话空闲多久后重置状态（秒）
+        """
+        self.alpha = alpha
+        self.bad_threshold = bad_threshold
+        self.good_threshold = good_threshold
+        self.sustain_frames = max(1, sustain_frames)
+        self.cooldown_seconds = cooldown_seconds
+        self.session_ttl = session_ttl
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        logger.info(
+            f"平滑服务初始化完成: alpha={alpha}, 阈值={bad_threshold}/{good_threshold}, "
+            f"持续帧数={self.sustain_frames}, 冷却={cooldown_seconds}s"
+        )
+
+    def update(self, session_id: str, parsed_result: PostureAnalysisResult, now: float = None) -> SmoothedResult:
+        """
+        用一帧检测结果更新会话状态
+
+        Args:
+            session_id: 会话标识（由前端生成，每台设备/每次打开页面一个）
+            parsed_result: 视觉模型解析后的结果
+            now: 当前时间戳（秒），为None则使用 time.time()
+
+        Returns:
+            SmoothedResult：
+            - score: 平滑后的分数
+            - is_qualified: 滞回判断后的合格状态
+            - should_remind: 是否应当提醒（生成语音）
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            self._evict_expired(now)
+
+            state = self._sessions.get(session_id)
+            if state is None:
+                state = _SessionState()
+                self._sessions[session_id] = state
+            state.last_seen = now
+
+            # 无人或不在写字时不参与平滑，也不提醒
+            if parsed_result.status != "normal":
+                state.bad_streak = 0
+                return self._snapshot(state, should_remind=False)
+
+            score = parsed_result.score
+            if state.smoothed_score is None:
+                state.smoothed_score = float(score)
+            else:
+                state.smoothed_score = self.alpha * score + (1 - self.alpha) * state.smoothed_score
+
+            if state.is_qualified and state.smoothed_score < self.bad_threshold:
+                state.is_qualified = False
+            elif not state.is_qualified and state.smoothed_score >= self.good_threshold:
+                state.is_qualified = True
+
+            if state.is_qualified:
+                state.bad_streak = 0
+                return self._snapshot(state, should_remind=False)
+
+            state.bad_streak += 1
+            if state.bad_streak < self.sustain_frames:
+                return self._snapshot(state, should_remind=False)
+
+            # issues 是模型输出的自由文本，措辞每帧都可能不同，因此按会话整体冷却
+            if state.last_reminded is not None and now - state.last_reminded < self.cooldown_seconds:
+                return self._snapshot(state, should_remind=False)
+
+            state.last_reminded = now
+            return self._snapshot(state, should_remind=True)
+
+    def reset(self, session_id: str):
+        """
+        清除会话状态
+
+        Args:
+            session_id: 会话标识
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict_expired(self, now: float):
+        """
+        清理长时间未活动的会话
+
+        Args:
+            now: 当前时间戳（秒）
+        """
+        expired = [
+            sid for sid, state in self._sessions.items()
+            if now - state.last_seen > self.session_ttl
+        ]
+        for sid in expired:
+            del self._sessions[sid]
+
+    def _snapshot(self, state: _SessionState, should_remind: bool) -> SmoothedResult:
+        """
+        生成会话状态的输出结果
+
+        Args:
+            state: 会话状态
+            should_remind: 是否应当提醒
+
+        Returns:
+            SmoothedResult
+        """
+        score = round(state.smoothed_score) if state.smoothed_score is not None else None
+        # 字段均由本服务计算，无需再次校验
+        return SmoothedResult.model_construct(
+            score=score,
+            is_qualified=state.is_qualified,
+            should_remind=should_remind,
+        )
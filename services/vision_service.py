@@ -1,10 +1,11 @@
 """
 视觉分析服务 - 调用 Doubao Vision API
 """
-import json
 import logging
 from openai import OpenAI
+from pydantic import ValidationError
 from config import ARK_API_KEY, ARK_MODEL_NAME, ARK_BASE_URL, POSTURE_SYSTEM_PROMPT
+from models.response_models import PostureAnalysisResult
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +34,7 @@ class VisionService:
         
         Returns:
             (parsed_result, full_response_dict) 元组：
-            - parsed_result: 解析后的结果字典，包含 score, is_qualified, issues, suggestion 等字段
+            - parsed_result: 校验后的 PostureAnalysisResult，包含 score, is_qualified, issues, suggestion 等字段
             - full_response_dict: 完整的响应对象（转换为字典），包含所有字段和思考过程
         """
         if not self.client:
@@ -84,16 +85,16 @@ class VisionService:
             # 将完整响应对象转换为字典（包含所有字段和思考过程）
             full_response_dict = self._response_to_dict(response)
             
-            # 清理并解析 JSON
+            # 清理、解析并校验 JSON
             content = self._clean_json_content(content)
-            parsed_result = json.loads(content)
+            parsed_result = PostureAnalysisResult.model_validate_json(content)
             
-            logger.info(f"视觉分析完成: status={parsed_result.get('status')}, score={parsed_result.get('score')}")
+            logger.info(f"视觉分析完成: status={parsed_result.status}, score={parsed_result.score}")
             
             return parsed_result, full_response_dict
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON 解析失败: {e}, 原始内容: {content[:200]}")
+        except ValidationError as e:
+            logger.error(f"JSON 解析或校验失败: {e}, 原始内容: {content[:200]}")
             # 即使解析失败，也返回完整的响应对象
             full_response_dict = self._response_to_dict(response) if 'response' in locals() else None
             return None, full_response_dict